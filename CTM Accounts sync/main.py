@@ -1,13 +1,14 @@
 import logging
 import base64
+import functools
+import itertools
+import orjson
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sys
 import os
 from datetime import datetime
-from google.cloud import bigquery
-from google.auth import default
-from pandas_gbq import to_gbq
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -45,13 +46,34 @@ PROJECT_ID = get_env_var('PROJECT_ID', required=False) or "data-etl-to-bigquery"
 DATASET_ID = "ctm_data"
 TABLE_ID = "accounts"
 DESTINATION_TABLE = f"{DATASET_ID}.{TABLE_ID}"
+STAGING_TABLE = f"{DATASET_ID}._{TABLE_ID}_stg"
 CTM_URL = "https://api.calltrackingmetrics.com/api/v1/accounts"
+COLUMNS_TO_KEEP = ["id", "name", "user_role", "status", "created", "updated", "canceled", "agency_id"]
+# Ask CTM for only COLUMNS_TO_KEEP via the `fields` selector (set CTM_REQUEST_FIELDS=true to enable)
+REQUEST_FIELDS = (get_env_var('CTM_REQUEST_FIELDS', required=False) or "").lower() in ("1", "true", "yes")
 
 # -------------------------
 # Auth Setup
 # -------------------------
-credentials, _ = default()
-bq_client = bigquery.Client(project=PROJECT_ID, credentials=credentials)
+@functools.lru_cache(maxsize=None)
+def get_bq_client():
+    """Create the BigQuery client on first use (keeps the no-data path light)"""
+    from google.auth import default
+    from google.cloud import bigquery
+
+    credentials, _ = default()
+    return bigquery.Client(project=PROJECT_ID, credentials=credentials)
+
+# -------------------------
+# HTTP Session Setup
+# -------------------------
+session = requests.Session()
+adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+)
+session.mount("https://", adapter)
 
 # -------------------------
 # Helper Functions
@@ -69,29 +91,50 @@ def build_auth_headers():
 def fetch_all_accounts():
     """Fetch all accounts from CTM API with pagination"""
     headers = build_auth_headers()
-    all_accounts = []
+    pages = []
+    total_accounts = 0
     url = CTM_URL
     params = {'per_page': 100}
+    if REQUEST_FIELDS:
+        params['fields'] = ','.join(COLUMNS_TO_KEEP)
 
     while url:
         logger.info(f"Fetching accounts from: {url}")
-        response = requests.get(url, headers=headers, params=params)
+        response = session.get(url, headers=headers, params=params)
         
         if response.status_code != 200:
             logger.error(f"❌ Failed to fetch accounts. Status {response.status_code}: {response.text}")
             raise Exception(f"API request failed with status {response.status_code}")
 
-        data = response.json()
+        data = orjson.loads(response.content)
         accounts = data.get("accounts", [])
-        all_accounts.extend(accounts)
+        pages.append(accounts)
+        total_accounts += len(accounts)
         
-        logger.info(f"Fetched {len(accounts)} accounts from this page. Total so far: {len(all_accounts)}")
+        logger.info(f"Fetched {len(accounts)} accounts from this page. Total so far: {total_accounts}")
 
         url = data.get("next_page")
         if url:
             params = None  # next_page contains full query params, so disable params on next call
 
-    return all_accounts
+    # Flatten once at the end instead of growing one list page by page
+    return list(itertools.chain.from_iterable(pages))
+
+def to_utc_timestamp(series):
+    """Convert a column to UTC timestamps, using the ISO 8601 fast path where possible"""
+    import pandas as pd
+
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        return series.dt.tz_convert("UTC")
+    if pd.api.types.is_numeric_dtype(series):
+        return pd.to_datetime(series, unit="s", errors="coerce", utc=True)
+
+    converted = pd.to_datetime(series, format="ISO8601", errors="coerce", utc=True)
+    # Fall back to flexible parsing only for values that are not ISO 8601
+    unparsed = converted.isna() & series.notna()
+    if unparsed.any():
+        converted[unparsed] = pd.to_datetime(series[unparsed], errors="coerce", utc=True)
+    return converted
 
 def process_accounts_data(accounts):
     """Process and clean accounts data"""
@@ -99,32 +142,111 @@ def process_accounts_data(accounts):
         logger.warning("⚠️ No account data to process.")
         return None
 
+    import pandas as pd
+
     df = pd.DataFrame(accounts)
-    columns_to_keep = ["id", "name", "user_role", "status", "created", "updated", "canceled", "agency_id"]
     
     # Keep only existing columns to avoid KeyError
-    existing_columns = [col for col in columns_to_keep if col in df.columns]
+    existing_columns = [col for col in COLUMNS_TO_KEEP if col in df.columns]
     df = df[existing_columns]
 
     # Convert timestamp columns
     timestamp_columns = ["created", "updated", "canceled"]
     for col in timestamp_columns:
         if col in df.columns:
-            df[col] = pd.to_datetime(df[col], errors="coerce")
+            df[col] = to_utc_timestamp(df[col])
+
+    # Low-cardinality columns are dictionary-encoded in Parquet and still load as STRING
+    categorical_columns = ["user_role", "status"]
+    for col in categorical_columns:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
 
     return df
 
+def load_dataframe(df, table_ref, schema=None):
+    """Load DataFrame into a BigQuery table, replacing its contents"""
+    from google.cloud.bigquery import LoadJobConfig, SourceFormat, WriteDisposition
+
+    job_config = LoadJobConfig(
+        source_format=SourceFormat.PARQUET,
+        write_disposition=WriteDisposition.WRITE_TRUNCATE,
+        schema=schema
+    )
+    job = get_bq_client().load_table_from_dataframe(df, table_ref, job_config=job_config)
+    job.result()
+
+def build_merge_sql(columns, cleared_columns, target_ref, staging_ref):
+    """Build a MERGE that syncs the target table to the staging table on id.
+    cleared_columns exist only in the target and are set to NULL, as a full replace would drop them."""
+    value_columns = [col for col in columns if col != "id"]
+    changed = " OR ".join(
+        [f"T.{col} IS DISTINCT FROM S.{col}" for col in value_columns]
+        + [f"T.{col} IS NOT NULL" for col in cleared_columns]
+    )
+    updates = ", ".join(
+        [f"{col} = S.{col}" for col in value_columns]
+        + [f"{col} = NULL" for col in cleared_columns]
+    )
+    column_list = ", ".join(columns)
+    source_values = ", ".join(f"S.{col}" for col in columns)
+    return f"""
+    MERGE `{target_ref}` T
+    USING `{staging_ref}` S
+    ON T.id = S.id
+    WHEN MATCHED AND ({changed}) THEN
+      UPDATE SET {updates}
+    WHEN NOT MATCHED THEN
+      INSERT ({column_list}) VALUES ({source_values})
+    WHEN NOT MATCHED BY SOURCE THEN
+      DELETE
+    """
+
 def upload_to_bigquery(df):
-    """Upload DataFrame to BigQuery"""
+    """Upload DataFrame to BigQuery, merging into the existing accounts table"""
+    from google.api_core.exceptions import NotFound
+
+    bq_client = get_bq_client()
+    target_ref = f"{PROJECT_ID}.{DESTINATION_TABLE}"
+    staging_ref = f"{PROJECT_ID}.{STAGING_TABLE}"
     logger.info(f"⬆️ Uploading {len(df)} account records to BigQuery table: {DESTINATION_TABLE}")
-    
-    to_gbq(
-        df,
-        destination_table=DESTINATION_TABLE,
-        project_id=PROJECT_ID,
-        if_exists="replace",
-        progress_bar=False
-    )
+
+    try:
+        table = bq_client.get_table(target_ref)
+    except NotFound:
+        # First run: nothing to merge into yet
+        logger.info(f"Table {DESTINATION_TABLE} not found, creating it from this run")
+        load_dataframe(df, target_ref)
+        logger.info("✅ Data successfully loaded to BigQuery.")
+        return
+
+    live_columns = {field.name for field in table.schema}
+    merge_columns = list(df.columns)
+
+    # Live columns this run did not return are cleared, matching the old full replace
+    cleared_columns = [field.name for field in table.schema if field.name not in df.columns]
+    if cleared_columns:
+        logger.warning(f"⚠️ Columns missing from this run will be set to NULL: {cleared_columns}")
+
+    # Stage with the live table's types for shared columns so MERGE compares like types,
+    # even when a column is all-null this run or the table predates tz-aware timestamps.
+    # Columns the live table lacks are typed from the frame.
+    staging_schema = [field for field in table.schema if field.name in df.columns]
+
+    # Stage this run's accounts, then merge so unchanged rows are left untouched
+    load_dataframe(df, staging_ref, schema=staging_schema)
+    try:
+        new_fields = [field for field in bq_client.get_table(staging_ref).schema if field.name not in live_columns]
+        if new_fields:
+            logger.warning(f"⚠️ Adding new columns to {DESTINATION_TABLE}: {[field.name for field in new_fields]}")
+            table.schema = list(table.schema) + new_fields
+            bq_client.update_table(table, ["schema"])
+
+        merge_job = bq_client.query(build_merge_sql(merge_columns, cleared_columns, target_ref, staging_ref))
+        merge_job.result()
+        logger.info(f"Merge affected {merge_job.num_dml_affected_rows} rows")
+    finally:
+        bq_client.delete_table(staging_ref, not_found_ok=True)
     
     logger.info("✅ Data successfully loaded to BigQuery.")
 
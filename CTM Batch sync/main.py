@@ -1,12 +1,16 @@
 import base64
-import requests
+import itertools
+import asyncio
+import aiohttp
+from aiolimiter import AsyncLimiter
 import pandas as pd
-from pandas_gbq import to_gbq
 from google.cloud import bigquery
+from google.cloud.bigquery import CopyJobConfig, LoadJobConfig, SourceFormat, WriteDisposition
 import re
 import time
-import json
+import orjson
 import datetime
+import uuid
 import logging
 from google.auth import default
 
@@ -58,31 +62,88 @@ headers = {
     'Content-Type': 'application/json'
 }
 
-# Rate limit config
+# Rate limit config (CTM quota is shared by every request in the job)
 REQUESTS_PER_SECOND = 8
-SLEEP_SECONDS = 1.0 / REQUESTS_PER_SECOND
+MAX_CONCURRENT_ACCOUNTS = 16
 
-def fetch_all_calls_for_account(account_id):
+# One token bucket shared by every fetch coroutine
+LIMITER = AsyncLimiter(REQUESTS_PER_SECOND, 1)
+
+async def fetch_calls_page(session, account_id, url, params):
+    """Fetch one page of calls; returns None if the request failed"""
+    print(f"    Fetching page for account {account_id}")
+    async with LIMITER:
+        async with session.get(url, headers=headers, params=params) as response:
+            if response.status != 200:
+                print(f"    Error {response.status} for account {account_id}")
+                return None
+            return orjson.loads(await response.read())
+
+async def fetch_all_calls_for_account(session, account_id):
     base_url = f'https://api.calltrackingmetrics.com/api/v1/accounts/{account_id}/calls'
-    all_calls = []
-    url = base_url
+    pages = []
     params = {'per_page': 100}
 
-    while url:
-        print(f"    Fetching page for account {account_id}")
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code != 200:
-            print(f"    Error {response.status_code} for account {account_id}")
+    # Start fetching the next page as soon as its URL is known, before processing the current one
+    pending = asyncio.create_task(fetch_calls_page(session, account_id, base_url, params))
+    while pending:
+        data = await pending
+        if data is None:
             break
-        data = response.json()
-        all_calls.extend(data.get('calls', []))
         url = data.get('next_page')
-        params = None
-        time.sleep(SLEEP_SECONDS)
+        pending = asyncio.create_task(fetch_calls_page(session, account_id, url, None)) if url else None
+        pages.append(data.get('calls', []))
     
+    all_calls = list(itertools.chain.from_iterable(pages))
     print(f"    Found {len(all_calls)} calls for account {account_id}")
     return all_calls
 
+async def fetch_calls_for_accounts(accounts):
+    """Fetch calls for all accounts concurrently under the shared rate limit"""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ACCOUNTS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_ACCOUNTS)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def fetch_with_slot(account_id):
+            async with semaphore:
+                return await fetch_all_calls_for_account(session, account_id)
+
+        tasks = [fetch_with_slot(account_id) for account_id, _ in accounts]
+        return await asyncio.gather(*tasks)
+
+# Upload config
+UPLOAD_CHUNK_ROWS = 50_000
+STAGING_TABLE_TTL = datetime.timedelta(days=1)
+
+def upload_in_chunks(client, df, table_ref, write_disposition):
+    """Upload DataFrame in chunks to a per-run staging table, then copy it to the target in one job"""
+    project, dataset, table = table_ref.split('.')
+    # Prefixed so a leftover staging table never looks like a target table
+    staging_ref = f"{project}.{dataset}._stg_{table}_{uuid.uuid4().hex[:12]}"
+
+    try:
+        for start in range(0, len(df), UPLOAD_CHUNK_ROWS):
+            chunk = df.iloc[start:start + UPLOAD_CHUNK_ROWS]
+            job_config = LoadJobConfig(
+                source_format=SourceFormat.PARQUET,
+                write_disposition=WriteDisposition.WRITE_APPEND
+            )
+            chunk_start = time.perf_counter()
+            client.load_table_from_dataframe(chunk, staging_ref, job_config=job_config).result()
+            print(f"    Staged rows {start + 1}-{start + len(chunk)} of {len(df)} in {time.perf_counter() - chunk_start:.2f}s")
+
+            if start == 0:
+                # Expire the staging table even if this run dies before cleaning it up
+                staging_table = client.get_table(staging_ref)
+                staging_table.expires = datetime.datetime.now(datetime.timezone.utc) + STAGING_TABLE_TTL
+                client.update_table(staging_table, ['expires'])
+
+        # One copy job, so the target gets every row or none of them and a retry starts clean
+        copy_config = CopyJobConfig(write_disposition=write_disposition)
+        client.copy_table(staging_ref, table_ref, job_config=copy_config).result()
+    finally:
+        client.delete_table(staging_ref, not_found_ok=True)
+
 def get_all_accounts():
     """Get all accounts ordered by ID"""
     client = bigquery.Client(project=project_id)
@@ -97,30 +158,25 @@ def get_all_accounts():
 def get_existing_batch_tables():
     """Get list of existing batch tables"""
     client = bigquery.Client(project=project_id)
+    query = f"""
+    SELECT table_name
+    FROM `{project_id}.{dataset_id}.INFORMATION_SCHEMA.TABLES`
+    WHERE STARTS_WITH(table_name, 'activities_raw_batch_')
+    """
     try:
-        dataset = client.get_dataset(f"{project_id}.{dataset_id}")
-        tables = list(client.list_tables(dataset))
-        batch_tables = [table.table_id for table in tables if table.table_id.startswith('activities_raw_batch_')]
-        return batch_tables
+        results = client.query(query).result()
+        return [row.table_name for row in results]
     except Exception as e:
         print(f"Could not get existing tables: {str(e)}")
         return []
 
-def get_next_batch_info():
-    """Determine which batch to process next"""
-    all_accounts = get_all_accounts()
-    existing_batches = get_existing_batch_tables()
-    
-    print(f"Total accounts: {len(all_accounts)}")
-    print(f"Existing batch tables: {existing_batches}")
-    
-    # Calculate batch number
-    batch_num = len(existing_batches) + 1
-    accounts_per_batch = 60
-    
-    # Calculate account range for this batch
-    start_idx = (batch_num - 1) * accounts_per_batch
-    end_idx = min(start_idx + accounts_per_batch, len(all_accounts))
+# Batch config
+ACCOUNTS_PER_BATCH = 60
+
+def get_batch_info(all_accounts, batch_num):
+    """Determine the account range covered by a batch number"""
+    start_idx = (batch_num - 1) * ACCOUNTS_PER_BATCH
+    end_idx = min(start_idx + ACCOUNTS_PER_BATCH, len(all_accounts))
     
     if start_idx >= len(all_accounts):
         return None, [], 0, 0  # No more batches needed
@@ -129,32 +185,70 @@ def get_next_batch_info():
     
     return batch_num, batch_accounts, start_idx, end_idx
 
-def clean_column_name(col):
-    col = re.sub(r'[^a-zA-Z0-9_]', '_', col)
-    if not re.match(r'^[a-zA-Z_]', col):
-        col = '_' + col
-    return col.lower()
+def get_next_batch_info(all_accounts, existing_batches):
+    """Determine which batch to process next"""
+    print(f"Total accounts: {len(all_accounts)}")
+    print(f"Existing batch tables: {existing_batches}")
+    
+    return get_batch_info(all_accounts, len(existing_batches) + 1)
+
+# Column name patterns, compiled once per process
+_NON_ALNUM = re.compile(r'[^a-zA-Z0-9_]')
+_LEADS_VALID = re.compile(r'^[a-zA-Z_]')
+
+def clean_column_names(columns):
+    """Clean all column names for BigQuery compatibility in one vectorized pass"""
+    cleaned = pd.Index(columns).astype(str).str.replace(_NON_ALNUM, '_', regex=True)
+    cleaned = cleaned.where(cleaned.str.match(_LEADS_VALID), '_' + cleaned)
+    return cleaned.str.lower()
+
+def serialize_nested_columns(df):
+    """Convert columns holding nested objects/lists to JSON strings"""
+    for col in df.select_dtypes(include='object').columns:
+        # Check every value: merged per-account frames can mix scalars and nested values
+        values = df[col]
+        nested = values.map(lambda v: isinstance(v, (dict, list)))
+        if nested.any():
+            df.loc[nested, col] = values[nested].map(lambda v: orjson.dumps(v).decode())
+    return df
 
-def main():
+def to_utc_timestamp(series):
+    """Convert a column to UTC timestamps, using the ISO 8601 fast path where possible"""
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        return series.dt.tz_convert('UTC')
+    if pd.api.types.is_numeric_dtype(series):
+        return pd.to_datetime(series, unit='s', errors='coerce', utc=True)
+
+    converted = pd.to_datetime(series, format='ISO8601', errors='coerce', utc=True)
+    # Fall back to flexible parsing only for values that are not ISO 8601
+    unparsed = converted.isna() & series.notna()
+    if unparsed.any():
+        converted[unparsed] = pd.to_datetime(series[unparsed], errors='coerce', utc=True)
+    return converted
+
+async def main():
     print("🚀 Starting batch table generator")
     
-    # Get next batch info
-    batch_num, accounts, start_idx, end_idx = get_next_batch_info()
+    # Get next batch info (accounts and existing tables are read once per run)
+    all_accounts = get_all_accounts()
+    existing_batches = get_existing_batch_tables()
+    batch_num, accounts, start_idx, end_idx = get_next_batch_info(all_accounts, existing_batches)
     
     if batch_num is None:
         print("✅ All batches have been completed!")
         print("\n🔗 Ready to join tables! Use this SQL:")
+        # Older batch tables store processed_at as an ISO string, newer ones as TIMESTAMP
         print(f"""
         CREATE OR REPLACE TABLE `{project_id}.{dataset_id}.activities_raw_combined` AS
-        SELECT *, 1 as batch_number FROM `{project_id}.{dataset_id}.activities_raw_batch_1`
+        SELECT * REPLACE (CAST(processed_at AS TIMESTAMP) AS processed_at, 1 AS batch_number) FROM `{project_id}.{dataset_id}.activities_raw_batch_1`
         UNION ALL
-        SELECT *, 2 as batch_number FROM `{project_id}.{dataset_id}.activities_raw_batch_2`
+        SELECT * REPLACE (CAST(processed_at AS TIMESTAMP) AS processed_at, 2 AS batch_number) FROM `{project_id}.{dataset_id}.activities_raw_batch_2`
         UNION ALL
-        SELECT *, 3 as batch_number FROM `{project_id}.{dataset_id}.activities_raw_batch_3`
+        SELECT * REPLACE (CAST(processed_at AS TIMESTAMP) AS processed_at, 3 AS batch_number) FROM `{project_id}.{dataset_id}.activities_raw_batch_3`
         UNION ALL
-        SELECT *, 4 as batch_number FROM `{project_id}.{dataset_id}.activities_raw_batch_4`
+        SELECT * REPLACE (CAST(processed_at AS TIMESTAMP) AS processed_at, 4 AS batch_number) FROM `{project_id}.{dataset_id}.activities_raw_batch_4`
         UNION ALL
-        SELECT *, 5 as batch_number FROM `{project_id}.{dataset_id}.activities_raw_batch_5`
+        SELECT * REPLACE (CAST(processed_at AS TIMESTAMP) AS processed_at, 5 AS batch_number) FROM `{project_id}.{dataset_id}.activities_raw_batch_5`
         -- Add more as needed
         """)
         return
@@ -174,51 +268,59 @@ def main():
     if len(accounts) > 5:
         print(f"  ... and {len(accounts) - 5} more")
     
-    all_calls = []
-    for account_id, account_name in accounts:
+    print(f"\n📡 Fetching calls for {len(accounts)} accounts concurrently")
+    calls_per_account = await fetch_calls_for_accounts(accounts)
+
+    # One UTC timestamp for the whole batch
+    processed_at = pd.Timestamp.now(tz='UTC')
+
+    frames = []
+    total_calls = 0
+    for (account_id, account_name), calls in zip(accounts, calls_per_account):
         print(f"\nProcessing account {account_id} - {account_name}")
-        calls = fetch_all_calls_for_account(account_id)
+        if not calls:
+            continue
 
         # Add account info and batch info
-        for call in calls:
-            call['account_id'] = account_id
-            call['account_name'] = account_name
-            call['batch_number'] = batch_num
-            call['processed_at'] = datetime.datetime.utcnow().isoformat()
-
-            # Convert nested objects/lists to JSON string
-            for k, v in call.items():
-                if isinstance(v, (dict, list)):
-                    call[k] = json.dumps(v)
+        account_df = pd.json_normalize(calls, max_level=0)
+        account_df['account_id'] = account_id
+        account_df['account_name'] = account_name
+        account_df['batch_number'] = batch_num
+        account_df['processed_at'] = processed_at
 
-        all_calls.extend(calls)
+        frames.append(account_df)
+        total_calls += len(calls)
 
-    print(f"\n📈 Total calls fetched for batch {batch_num}: {len(all_calls)}")
+    print(f"\n📈 Total calls fetched for batch {batch_num}: {total_calls}")
 
-    if not all_calls:
+    if not frames:
         print(f"No calls fetched for batch {batch_num}")
         return
 
-    df = pd.json_normalize(all_calls)
+    df = pd.concat(frames, ignore_index=True, sort=False)
+
+    # Convert nested objects/lists to JSON string
+    df = serialize_nested_columns(df)
 
     # Convert timestamps
     for date_col in ['called_at', 'billed_at']:
         if date_col in df.columns:
-            df[date_col] = pd.to_datetime(df[date_col], errors='coerce', utc=True)
+            df[date_col] = to_utc_timestamp(df[date_col])
 
     # Clean columns for BigQuery
-    df.columns = [clean_column_name(c) for c in df.columns]
+    df.columns = clean_column_names(df.columns)
 
     print(f"DataFrame shape: {df.shape}")
     print(f"Columns: {len(df.columns)}")
 
     # Always use 'replace' for batch tables (each is independent)
-    to_gbq(df, destination_table, project_id=project_id, if_exists='replace')
+    client = bigquery.Client(project=project_id)
+    upload_in_chunks(client, df, f"{project_id}.{destination_table}", WriteDisposition.WRITE_TRUNCATE)
     
     print(f"✅ Batch {batch_num} uploaded to {destination_table}")
     
     # Show what's next
-    next_batch_num, next_accounts, next_start, next_end = get_next_batch_info()
+    next_batch_num, next_accounts, next_start, next_end = get_batch_info(all_accounts, batch_num + 1)
     if next_batch_num:
         print(f"\n⏭️  Next: Batch {next_batch_num} ({len(next_accounts)} accounts)")
         print("💡 Run this job again to process the next batch")
@@ -229,4 +331,4 @@ def main():
         print("\n🔗 Ready to join all tables with SQL!")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
@@ -1,12 +1,16 @@
 import base64
-import requests
+import itertools
+import asyncio
+import aiohttp
+from aiolimiter import AsyncLimiter
 import pandas as pd
-from pandas_gbq import to_gbq
 from google.cloud import bigquery
+from google.cloud.bigquery import CopyJobConfig, LoadJobConfig, SourceFormat, WriteDisposition
 import re
 import time
-import json
+import orjson
 import datetime
+import uuid
 import os
 import sys
 import logging
@@ -57,9 +61,13 @@ headers = {
     'Content-Type': 'application/json'
 }
 
-# Rate limit config
+# Rate limit config (CTM quota is shared by every request in the job)
 REQUESTS_PER_SECOND = 8
-SLEEP_SECONDS = 1.0 / REQUESTS_PER_SECOND
+MAX_CONCURRENT_ACCOUNTS = 16
+PER_PAGE = 100
+
+# One token bucket shared by every fetch coroutine
+LIMITER = AsyncLimiter(REQUESTS_PER_SECOND, 1)
 
 # -------------------------
 # Auth and Client Setup
@@ -70,83 +78,129 @@ bq_client = bigquery.Client(project=project_id, credentials=credentials)
 # -------------------------
 # Helper Functions
 # -------------------------
+def get_target_schema(table_ref):
+    """Fetch target table schema (SchemaField list) from BigQuery"""
+    return bq_client.get_table(table_ref).schema
+
 def standardize_dataframe_schema(df, target_table_project, target_table_dataset, target_table_name):
     """
-    Standardize DataFrame schema to match target BigQuery table
+    Standardize DataFrame schema to match target BigQuery table.
+    Returns the DataFrame and the target schema, or None for the schema if it could not be applied.
     """
     try:
-        # Get target table schema
+        # Get all expected columns from target table (fetched once and reused for the upload)
         table_ref = f"{target_table_project}.{target_table_dataset}.{target_table_name}"
-        table = bq_client.get_table(table_ref)
-        
-        # Get all expected columns from target table
-        expected_columns = {field.name: field.field_type for field in table.schema}
+        schema = get_target_schema(table_ref)
+        expected_columns = [field.name for field in schema]
+        expected_column_names = set(expected_columns)
         logger.info(f"Target table has {len(expected_columns)} columns")
         logger.info(f"Current DataFrame has {len(df.columns)} columns")
         
-        # Add missing columns with appropriate default values
-        missing_columns = set(expected_columns.keys()) - set(df.columns)
+        missing_columns = expected_column_names - set(df.columns)
         if missing_columns:
             logger.info(f"Adding {len(missing_columns)} missing columns: {missing_columns}")
-            for col in missing_columns:
-                field_type = expected_columns[col]
-                # Set default values based on BigQuery field type
-                if field_type in ['STRING', 'TEXT']:
-                    df[col] = None  # Will become NULL in BigQuery
-                elif field_type in ['INTEGER', 'INT64']:
-                    df[col] = None
-                elif field_type in ['FLOAT', 'FLOAT64', 'NUMERIC']:
-                    df[col] = None
-                elif field_type in ['BOOLEAN', 'BOOL']:
-                    df[col] = None
-                elif field_type in ['TIMESTAMP', 'DATETIME', 'DATE', 'TIME']:
-                    df[col] = None
-                else:
-                    df[col] = None  # Default to NULL for unknown types
         
-        # Remove columns that don't exist in target table
-        extra_columns = set(df.columns) - set(expected_columns.keys())
+        extra_columns = set(df.columns) - expected_column_names
         if extra_columns:
             logger.info(f"Removing {len(extra_columns)} extra columns: {extra_columns}")
-            df = df.drop(columns=list(extra_columns))
         
-        # Reorder columns to match target table order
-        target_column_order = [field.name for field in table.schema]
-        df = df[target_column_order]
+        # Add missing, drop extra and reorder to match target table in one pass
+        df = df.reindex(columns=expected_columns)
+        if missing_columns:
+            # reindex fills with float NaN; keep new columns as untyped NULLs for the loader
+            df[list(missing_columns)] = None
         
         logger.info(f"✅ Schema standardized: {len(df.columns)} columns")
-        return df
+        return df, schema
         
     except Exception as e:
         logger.error(f"❌ Error standardizing schema: {str(e)}")
-        return df
+        return df, None
+
+async def fetch_calls_page(session, account_id, url, params):
+    """Fetch a single page of calls for an account"""
+    logger.info(f"Fetching calls for account {account_id}: {url} with params {params}")
+    async with LIMITER:
+        async with session.get(url, headers=headers, params=params) as response:
+            if response.status != 200:
+                raise Exception(f"Error fetching data for account {account_id}: {response.status} {await response.text()}")
+            return orjson.loads(await response.read())
 
-def fetch_all_calls_for_account(account_id):
+async def fetch_all_calls_for_account(session, account_id):
     """Fetch all calls for a specific account"""
     base_url = f'https://api.calltrackingmetrics.com/api/v1/accounts/{account_id}/calls'
-    all_calls = []
-    url = base_url
+    pages = []
     yesterday = datetime.datetime.utcnow() - datetime.timedelta(days=1)
     today_str = yesterday.strftime('%Y-%m-%d')
 
     params = {
-        'per_page': 100,
+        'per_page': PER_PAGE,
         'start_date': today_str,
         'end_date': today_str
     }
 
-    while url:
-        logger.info(f"Fetching calls for account {account_id}: {url} with params {params}")
-        response = requests.get(url, headers=headers, params=params)
-        if response.status_code != 200:
-            raise Exception(f"Error fetching data for account {account_id}: {response.status_code} {response.text}")
-        data = response.json()
-        all_calls.extend(data.get('calls', []))
+    # Start fetching the next page as soon as its URL is known, before processing the current one
+    pending = asyncio.create_task(fetch_calls_page(session, account_id, base_url, params))
+    while pending:
+        data = await pending
+        page_calls = data.get('calls', [])
         url = data.get('next_page')
-        params = None  # Next page URL includes all params already
-        time.sleep(SLEEP_SECONDS)
+        # A short page is the last one, even if a stale next_page is returned
+        if len(page_calls) < PER_PAGE:
+            url = None
+        # Next page URL includes all params already
+        pending = asyncio.create_task(fetch_calls_page(session, account_id, url, None)) if url else None
+        pages.append(page_calls)
+
+    return list(itertools.chain.from_iterable(pages))
 
-    return all_calls
+async def fetch_calls_for_accounts(accounts):
+    """Fetch calls for all accounts concurrently under the shared rate limit"""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ACCOUNTS)
+    connector = aiohttp.TCPConnector(limit=MAX_CONCURRENT_ACCOUNTS)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        async def fetch_with_slot(account_id):
+            async with semaphore:
+                return await fetch_all_calls_for_account(session, account_id)
+
+        tasks = [fetch_with_slot(account_id) for account_id, _ in accounts]
+        return await asyncio.gather(*tasks)
+
+# Upload config
+UPLOAD_CHUNK_ROWS = 50_000
+STAGING_TABLE_TTL = datetime.timedelta(days=1)
+
+def upload_in_chunks(client, df, table_ref, write_disposition, schema=None):
+    """Upload DataFrame in chunks to a per-run staging table, then copy it to the target in one job"""
+    project, dataset, table = table_ref.split('.')
+    # Prefixed so a leftover staging table never looks like a target table
+    staging_ref = f"{project}.{dataset}._stg_{table}_{uuid.uuid4().hex[:12]}"
+
+    try:
+        for start in range(0, len(df), UPLOAD_CHUNK_ROWS):
+            chunk = df.iloc[start:start + UPLOAD_CHUNK_ROWS]
+            # An explicit schema saves the client a get_table call per chunk
+            job_config = LoadJobConfig(
+                source_format=SourceFormat.PARQUET,
+                write_disposition=WriteDisposition.WRITE_APPEND,
+                schema=schema
+            )
+            chunk_start = time.perf_counter()
+            client.load_table_from_dataframe(chunk, staging_ref, job_config=job_config).result()
+            logger.info(f"Staged rows {start + 1}-{start + len(chunk)} of {len(df)} in {time.perf_counter() - chunk_start:.2f}s")
+
+            if start == 0:
+                # Expire the staging table even if this run dies before cleaning it up
+                staging_table = client.get_table(staging_ref)
+                staging_table.expires = datetime.datetime.now(datetime.timezone.utc) + STAGING_TABLE_TTL
+                client.update_table(staging_table, ['expires'])
+
+        # One copy job, so the target gets every row or none of them and a retry starts clean
+        copy_config = CopyJobConfig(write_disposition=write_disposition)
+        client.copy_table(staging_ref, table_ref, job_config=copy_config).result()
+    finally:
+        client.delete_table(staging_ref, not_found_ok=True)
 
 def get_active_accounts():
     """Get active accounts from BigQuery"""
@@ -157,17 +211,44 @@ def get_active_accounts():
     results = bq_client.query(query).result()
     return [(row.id, row.name) for row in results]
 
-def clean_column_name(col):
-    """Clean column names for BigQuery compatibility"""
-    col = re.sub(r'[^a-zA-Z0-9_]', '_', col)
-    if not re.match(r'^[a-zA-Z_]', col):
-        col = '_' + col
-    return col.lower()
+# Column name patterns, compiled once per process
+_NON_ALNUM = re.compile(r'[^a-zA-Z0-9_]')
+_LEADS_VALID = re.compile(r'^[a-zA-Z_]')
+
+def clean_column_names(columns):
+    """Clean all column names for BigQuery compatibility in one vectorized pass"""
+    cleaned = pd.Index(columns).astype(str).str.replace(_NON_ALNUM, '_', regex=True)
+    cleaned = cleaned.where(cleaned.str.match(_LEADS_VALID), '_' + cleaned)
+    return cleaned.str.lower()
+
+def serialize_nested_columns(df):
+    """Convert columns holding nested objects/lists to JSON strings"""
+    for col in df.select_dtypes(include='object').columns:
+        # Check every value: merged per-account frames can mix scalars and nested values
+        values = df[col]
+        nested = values.map(lambda v: isinstance(v, (dict, list)))
+        if nested.any():
+            df.loc[nested, col] = values[nested].map(lambda v: orjson.dumps(v).decode())
+    return df
+
+def to_utc_timestamp(series):
+    """Convert a column to UTC timestamps, using the ISO 8601 fast path where possible"""
+    if isinstance(series.dtype, pd.DatetimeTZDtype):
+        return series.dt.tz_convert('UTC')
+    if pd.api.types.is_numeric_dtype(series):
+        return pd.to_datetime(series, unit='s', errors='coerce', utc=True)
+
+    converted = pd.to_datetime(series, format='ISO8601', errors='coerce', utc=True)
+    # Fall back to flexible parsing only for values that are not ISO 8601
+    unparsed = converted.isna() & series.notna()
+    if unparsed.any():
+        converted[unparsed] = pd.to_datetime(series[unparsed], errors='coerce', utc=True)
+    return converted
 
 # -------------------------
 # Main Job Function
 # -------------------------
-def main():
+async def main():
     start_time = datetime.datetime.now()
     
     # Log job start with structured logging
@@ -184,31 +265,31 @@ def main():
         accounts = get_active_accounts()
         logger.info(f"Found {len(accounts)} active accounts")
 
-        all_calls = []
+        # Fetch calls for every account concurrently
+        calls_per_account = await fetch_calls_for_accounts(accounts)
+
+        frames = []
+        total_calls = 0
         accounts_processed = 0
         
         # Process each account
-        for account_id, account_name in accounts:
+        for (account_id, account_name), calls in zip(accounts, calls_per_account):
             logger.info(f"Processing account {account_id} - {account_name}")
-            calls = fetch_all_calls_for_account(account_id)
 
-            # Add account info to each call
-            for call in calls:
-                call['account_id'] = account_id
-                call['account_name'] = account_name
+            if calls:
+                # Normalize per account and add account info as columns
+                account_df = pd.json_normalize(calls, max_level=0)
+                account_df['account_id'] = account_id
+                account_df['account_name'] = account_name
+                frames.append(account_df)
 
-                # Convert nested objects/lists to JSON string to avoid schema errors
-                for k, v in call.items():
-                    if isinstance(v, (dict, list)):
-                        call[k] = json.dumps(v)
-
-            all_calls.extend(calls)
+            total_calls += len(calls)
             accounts_processed += 1
             logger.info(f"Account {account_id} processed: {len(calls)} calls")
 
-        logger.info(f"Total calls fetched: {len(all_calls)}")
+        logger.info(f"Total calls fetched: {total_calls}")
 
-        if not all_calls:
+        if not frames:
             logger.info("⚠️ No calls fetched, job completed with no data to process.")
             
             # Log successful completion with zero data
@@ -225,28 +306,32 @@ def main():
             })
             return
 
-        # Create DataFrame from normalized JSON
-        df = pd.json_normalize(all_calls)
+        # Combine per-account frames
+        df = pd.concat(frames, ignore_index=True, sort=False)
+
+        # Convert nested objects/lists to JSON string to avoid schema errors
+        df = serialize_nested_columns(df)
 
         # Convert timestamps (if present)
         for date_col in ['called_at', 'billed_at']:
             if date_col in df.columns:
-                df[date_col] = pd.to_datetime(df[date_col], errors='coerce', utc=True)
+                df[date_col] = to_utc_timestamp(df[date_col])
 
         # Clean columns for BigQuery
-        df.columns = [clean_column_name(c) for c in df.columns]
+        df.columns = clean_column_names(df.columns)
 
         logger.info(f"DataFrame shape before standardization: {df.shape}")
         
         # Standardize schema before upload
-        df = standardize_dataframe_schema(df, project_id, dataset_id, raw_table_id)
+        df, target_schema = standardize_dataframe_schema(df, project_id, dataset_id, raw_table_id)
         
         logger.info(f"DataFrame shape after standardization: {df.shape}")
         logger.info("Sample of standardized data:")
         logger.info(df.head(2).to_string())
 
         # Upload to BigQuery
-        to_gbq(df, destination_table, project_id=project_id, if_exists='append')
+        # Without a target schema (e.g. table not created yet) the load infers types from the frame
+        upload_in_chunks(bq_client, df, f"{project_id}.{destination_table}", WriteDisposition.WRITE_APPEND, schema=target_schema)
         logger.info(f"✅ Data uploaded to {destination_table}")
 
         # Calculate processing time
@@ -258,7 +343,7 @@ def main():
             'job_name': 'ctm_daily_sync',
             'status': 'SUCCESS',
             'total_accounts_processed': accounts_processed,
-            'total_calls_fetched': len(all_calls),
+            'total_calls_fetched': total_calls,
             'dataframe_rows': len(df),
             'dataframe_columns': len(df.columns),
             'processing_time_seconds': round(processing_time, 2),
@@ -282,4 +367,4 @@ def main():
         raise
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file